@@ -1,7 +1,7 @@
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file
 from datetime import datetime
 from employee_management import EmployeeManagement
-from excel_manager import ExcelManager
+from excel_manager import ExcelManager, parsuj_datum
 from zalohy_manager import ZalohyManager
 import logging
 import os
@@ -155,7 +155,7 @@ def record_time():
         lunch_duration = float(request.form.get('lunch_duration', 0))
         
         try:
-            date_obj = datetime.strptime(date, '%Y-%m-%d')
+            date_obj = parsuj_datum(date)
             
             excel_manager.ulozit_pracovni_dobu(date_obj, start_time, end_time, lunch_duration, employee_manager.vybrani_zamestnanci)
             
@@ -1,37 +1,200 @@
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from zipfile import ZipFile, ZIP_DEFLATED
+from filelock import FileLock
 from openpyxl import load_workbook, Workbook
-from openpyxl.utils import get_column_letter
-from datetime import datetime, timedelta
+from openpyxl.xml import LXML
+from openpyxl.writer.excel import ExcelWriter
+from datetime import date, datetime, time, timedelta, timezone
 import logging
 
 logging.basicConfig(filename='evidence_pracovni_doby.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+if not LXML:
+    # Bez lxml openpyxl parsuje i zapisuje přes pomalejší xml.etree
+    logging.warning("Knihovna lxml není nainstalována, načítání a ukládání Excelu bude pomalejší")
+
+# Načtené sešity sdílené v rámci procesu: absolutní cesta -> (razítko souboru, workbook).
+# Sešit se znovu parsuje jen tehdy, když se soubor na disku změnil.
+# Nejdéle nepoužité sešity se vyřazují, aby dlouho běžící proces nedržel v paměti
+# každý soubor, na který kdy sáhl (sešity v cache jsou vždy uložené, nic se neztratí)
+_CACHE_SESITU = OrderedDict()
+MAX_SESITU_V_CACHE = 4
+# Krátký zámek jen pro slovníky; načítání, úpravy a ukládání souboru hlídá zámek dané cesty
+# (vlákna v procesu i ostatní procesy, např. více workerů gunicornu)
+_ZAMEK_CACHE = threading.Lock()
+_ZAMKY_SOUBORU = {}
+
+# Formát data zapisovaného do řádku 80 týdenních listů
+FORMAT_DATA_LISTU = "%d.%m.%Y"
+
+# Sloupec začátku (a pracovní doby, data v řádku 80) pro každý den týdne; konec je o sloupec dál
+_SLOUPCE_DNU = tuple(2 + den * 2 for den in range(7))
+
+# Jak dlouho čekat na zámkový soubor, který drží jiný proces
+TIMEOUT_ZAMKU_S = 30
+
+class _ZamekSouboru:
+    # RLock pro vlákna tohoto procesu a zámkový soubor vedle sešitu pro ostatní procesy.
+    # Oba jsou reentrantní, takže vnořené volání ve stejném vlákně se nezablokuje.
+    def __init__(self, klic):
+        self._vlakna = threading.RLock()
+        self._procesy = FileLock(klic + ".lock", timeout=TIMEOUT_ZAMKU_S)
+
+    def __enter__(self):
+        self._vlakna.acquire()
+        try:
+            self._procesy.acquire()
+        except BaseException:
+            self._vlakna.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._procesy.release()
+        finally:
+            self._vlakna.release()
+
+def zamek_souboru(cesta, klic=None):
+    # Zámek dané cesty hlídá načtení, úpravy i uložení sdíleného sešitu
+    klic = klic or os.path.abspath(cesta)
+    with _ZAMEK_CACHE:
+        zamek = _ZAMKY_SOUBORU.get(klic)
+        if zamek is None:
+            zamek = _ZAMKY_SOUBORU[klic] = _ZamekSouboru(klic)
+        return zamek
+
+def razitko_souboru(cesta):
+    # Čas změny i velikost: přepis souboru ve stejném tiku hodin (hrubé mtime na FAT/SMB)
+    # se většinou projeví jinou velikostí
+    stav = os.stat(cesta)
+    return stav.st_mtime_ns, stav.st_size
+
+def nacteny_sesit(cesta, klic=None):
+    # Vrátí sešit z cache, pokud se soubor od načtení nezměnil, jinak None.
+    # Jediné volání stat zároveň ověří existenci souboru i jeho razítko.
+    with _ZAMEK_CACHE:
+        klic = klic or os.path.abspath(cesta)
+        ulozeny = _CACHE_SESITU.get(klic)
+        if ulozeny is not None:
+            _CACHE_SESITU.move_to_end(klic)
+    if ulozeny is None:
+        return None
+    try:
+        razitko = razitko_souboru(cesta)
+    except FileNotFoundError:
+        return None
+    return ulozeny[1] if ulozeny[0] == razitko else None
+
+def zapamatuj_sesit(workbook, cesta, klic=None):
+    razitko = razitko_souboru(cesta)
+    with _ZAMEK_CACHE:
+        klic = klic or os.path.abspath(cesta)
+        _CACHE_SESITU[klic] = (razitko, workbook)
+        _CACHE_SESITU.move_to_end(klic)
+        while len(_CACHE_SESITU) > MAX_SESITU_V_CACHE:
+            _CACHE_SESITU.popitem(last=False)
+
+def zapomen_sesit(cesta, klic=None):
+    # Po chybě uprostřed zápisu nesmí v cache zůstat napůl upravený sešit
+    with _ZAMEK_CACHE:
+        _CACHE_SESITU.pop(klic or os.path.abspath(cesta), None)
+
+def uloz_atomicky(workbook, cesta):
+    # Sešit se zapíše do dočasného souboru vedle cílového a pak se atomicky přejmenuje,
+    # takže pád uprostřed ukládání nezanechá rozepsaný soubor
+    zaklad, pripona = os.path.splitext(cesta)
+    docasna_cesta = f"{zaklad}.{os.getpid()}.tmp{pripona}"
+    try:
+        # Jako Workbook.save, jen s rychlejší kompresí (soubor je o něco větší, uložení rychlejší)
+        workbook.properties.modified = datetime.now(tz=timezone.utc).replace(tzinfo=None)
+        with ZipFile(docasna_cesta, 'w', ZIP_DEFLATED, allowZip64=True, compresslevel=1) as archiv:
+            ExcelWriter(workbook, archiv).save()
+        os.replace(docasna_cesta, cesta)
+    except Exception:
+        if os.path.exists(docasna_cesta):
+            os.remove(docasna_cesta)
+        raise
+
+@lru_cache(maxsize=1024)
+def parsuj_datum(text):
+    # Pevný formát RRRR-MM-DD z formulářů; řezy a int jsou výrazně rychlejší než strptime
+    # isascii + isdigit: int() by jinak přijal i znaménka, mezery, podtržítka a ne-ASCII číslice
+    rok, mesic, den = text[0:4], text[5:7], text[8:10]
+    if (len(text) != 10 or text[4] != '-' or text[7] != '-'
+            or not text.isascii() or not (rok + mesic + den).isdigit()):
+        raise ValueError(f"Neplatné datum '{text}', očekáván formát RRRR-MM-DD")
+    return date(int(rok), int(mesic), int(den))
+
+def parsuj_cas(text):
+    # Ekvivalent strptime(text, "%H:%M") včetně jednociferné hodiny ("7:30")
+    hodiny, oddelovac, minuty = text.partition(':')
+    if (not oddelovac or not 1 <= len(hodiny) <= 2 or not 1 <= len(minuty) <= 2
+            or not text.isascii() or not (hodiny + minuty).isdigit()):
+        raise ValueError(f"Neplatný čas '{text}', očekáván formát HH:MM")
+    return time(int(hodiny), int(minuty))
+
 class ExcelManager:
     def __init__(self):
         self.excel_cesta = "Hodiny_Cap.xlsx"
         self.TEMPLATE_SHEET_NAME = 'Týden'
+        self._klic = (None, None)  # (excel_cesta, absolutní cesta) pro klíč do cache sešitů
+
+    def __getstate__(self):
+        # Absolutní cesta závisí na pracovním adresáři, po obnovení se spočítá znovu
+        stav = self.__dict__.copy()
+        stav['_klic'] = (None, None)
+        return stav
+
+    def _klic_cache(self):
+        # os.path.abspath volá os.getcwd; přepočítá se jen při změně excel_cesta
+        if self._klic[0] != self.excel_cesta:
+            self._klic = (self.excel_cesta, os.path.abspath(self.excel_cesta))
+        return self._klic[1]
 
     def nacti_nebo_vytvor_excel(self):
         try:
-            if os.path.exists(self.excel_cesta):
-                try:
-                    workbook = load_workbook(self.excel_cesta)
-                    logging.info(f"Načten existující Excel soubor: {self.excel_cesta}")
-                except Exception as e:
-                    logging.warning(f"Nelze načíst existující soubor, vytvářím nový: {e}")
+            klic = self._klic_cache()
+            workbook = nacteny_sesit(self.excel_cesta, klic)
+            if workbook is not None:
+                return workbook
+            with zamek_souboru(self.excel_cesta, klic):
+                if os.path.exists(self.excel_cesta):
+                    # Jiné vlákno mohlo sešit načíst, zatímco jsme čekali na zámek
+                    workbook = nacteny_sesit(self.excel_cesta, klic)
+                    if workbook is not None:
+                        return workbook
+                    try:
+                        workbook = load_workbook(self.excel_cesta)
+                        logging.info(f"Načten existující Excel soubor: {self.excel_cesta}")
+                    except Exception as e:
+                        logging.warning(f"Nelze načíst existující soubor, vytvářím nový: {e}")
+                        workbook = Workbook()
+                        workbook.save(self.excel_cesta)
+                        logging.info(f"Vytvořen nový Excel soubor se stejným názvem: {self.excel_cesta}")
+                else:
                     workbook = Workbook()
                     workbook.save(self.excel_cesta)
-                    logging.info(f"Vytvořen nový Excel soubor se stejným názvem: {self.excel_cesta}")
-            else:
-                workbook = Workbook()
-                workbook.save(self.excel_cesta)
-                logging.info(f"Vytvořen nový Excel soubor: {self.excel_cesta}")
-            return workbook
+                    logging.info(f"Vytvořen nový Excel soubor: {self.excel_cesta}")
+                zapamatuj_sesit(workbook, self.excel_cesta, klic)
+                return workbook
         except Exception as e:
             logging.error(f"Chyba při načítání nebo vytváření Excel souboru: {e}")
             raise
 
+    def uloz_excel(self, workbook):
+        klic = self._klic_cache()
+        with zamek_souboru(self.excel_cesta, klic):
+            uloz_atomicky(workbook, self.excel_cesta)
+            zapamatuj_sesit(workbook, self.excel_cesta, klic)
+
+    def zahod_nacteny_excel(self):
+        zapomen_sesit(self.excel_cesta, self._klic_cache())
+
     def ziskej_nebo_vytvor_list(self, workbook, datum):
         try:
             cislo_tydne = datum.isocalendar()[1]
@@ -42,7 +205,7 @@ class ExcelManager:
                     sablona = workbook[self.TEMPLATE_SHEET_NAME]
                     novy_list = workbook.copy_worksheet(sablona)
                     novy_list.title = nazev_listu
-                    novy_list['A80'] = nazev_listu
+                    novy_list.cell(row=80, column=1, value=nazev_listu)
                 else:
                     novy_list = workbook.create_sheet(title=nazev_listu)
                     self.inicializuj_list(novy_list, datum)
@@ -61,59 +224,106 @@ class ExcelManager:
         dny = ["Pondělí", "Úterý", "Středa", "Čtvrtek", "Pátek", "Sobota", "Neděle"]
         prvni_den_tydne = datum - timedelta(days=datum.weekday())
         for i, den in enumerate(dny):
-            sheet.cell(row=6, column=2 + i * 2, value=den)
+            sheet.cell(row=6, column=_SLOUPCE_DNU[i], value=den)
             datum_bunky = prvni_den_tydne + timedelta(days=i)
-            sheet.cell(row=80, column=2 + i * 2, value=datum_bunky.strftime("%d.%m.%Y"))
+            sheet.cell(row=80, column=_SLOUPCE_DNU[i], value=datum_bunky.strftime(FORMAT_DATA_LISTU))
 
     def ulozit_pracovni_dobu(self, datum, zacatek, konec, obed, vybrani_zamestnanci):
         try:
-            workbook = self.nacti_nebo_vytvor_excel()
-            sheet = self.ziskej_nebo_vytvor_list(workbook, datum)
-
-            den_v_tydnu = datum.weekday()
-            sheet.cell(row=7, column=2 + den_v_tydnu * 2, value=zacatek)
-            sheet.cell(row=7, column=3 + den_v_tydnu * 2, value=konec)
-            sheet.cell(row=80, column=2 + datum.weekday() * 2, value=datum.strftime("%d.%m.%Y"))
-
-            if zacatek != 'X' and konec != 'X':
-                zacatek_cas = datetime.strptime(zacatek, "%H:%M")
-                konec_cas = datetime.strptime(konec, "%H:%M")
-                pracovni_doba = max((konec_cas - zacatek_cas).total_seconds() / 3600 - obed, 0)
-                sheet.cell(row=8, column=2 + den_v_tydnu * 2, value=pracovni_doba)
+            with zamek_souboru(self.excel_cesta, self._klic_cache()):
+                workbook = self.nacti_nebo_vytvor_excel()
+                pocet_listu = len(workbook.worksheets)
+                sheet = self.ziskej_nebo_vytvor_list(workbook, datum)
+
+                den_v_tydnu = datum.weekday()
+                sloupec_dne = _SLOUPCE_DNU[den_v_tydnu]
+                # Zápisy se nejdřív posbírají jako (řádek, sloupec, hodnota) a provedou se naráz
+                zapisy = [
+                    (7, sloupec_dne, zacatek),
+                    (7, sloupec_dne + 1, konec),
+                    (80, sloupec_dne, datum.strftime(FORMAT_DATA_LISTU)),
+                ]
+
+                if zacatek != 'X' and konec != 'X':
+                    zacatek_cas = parsuj_cas(zacatek)
+                    konec_cas = parsuj_cas(konec)
+                    odpracovane_minuty = (konec_cas.hour * 60 + konec_cas.minute) - (zacatek_cas.hour * 60 + zacatek_cas.minute)
+                    pracovni_doba = max(odpracovane_minuty / 60 - obed, 0)
+                    zapisy.append((8, sloupec_dne, pracovni_doba))
                 
-                # Zápis pracovní doby pro vybrané zaměstnance
-                for i, zamestnanec in enumerate(vybrani_zamestnanci):
-                    row = 9 + i  # Začínáme od řádku 9 pro zaměstnance
-                    sheet.cell(row=row, column=1, value=zamestnanec)
-                    sheet.cell(row=row, column=2 + den_v_tydnu * 2, value=pracovni_doba)
-            else:
-                sheet.cell(row=8, column=2 + den_v_tydnu * 2, value='X')
-                sheet.cell(row=9, column=2 + den_v_tydnu * 2, value='X')
+                    # Zápis pracovní doby pro vybrané zaměstnance
+                    for i, zamestnanec in enumerate(vybrani_zamestnanci):
+                        row = 9 + i  # Začínáme od řádku 9 pro zaměstnance
+                        zapisy.append((row, 1, zamestnanec))
+                        zapisy.append((row, sloupec_dne, pracovni_doba))
+                else:
+                    zapisy.append((8, sloupec_dne, 'X'))
+                    zapisy.append((9, sloupec_dne, 'X'))
                 
-                # Zápis 'X' pro vybrané zaměstnance v případě nepracovního dne
-                for i, zamestnanec in enumerate(vybrani_zamestnanci):
-                    row = 10 + i
-                    sheet.cell(row=row, column=1, value=zamestnanec)
-                    sheet.cell(row=row, column=2 + den_v_tydnu * 2, value='X')
-
-            workbook.save(self.excel_cesta)
-            logging.info(f"Data úspěšně uložena do souboru: {self.excel_cesta}")
+                    # Zápis 'X' pro vybrané zaměstnance v případě nepracovního dne
+                    for i, zamestnanec in enumerate(vybrani_zamestnanci):
+                        row = 10 + i
+                        zapisy.append((row, 1, zamestnanec))
+                        zapisy.append((row, sloupec_dne, 'X'))
+
+                # Nový list nebo jakákoli změněná buňka znamená uložení; jinak je soubor aktuální
+                zmeneno = len(workbook.worksheets) != pocet_listu
+                for row, column, hodnota in zapisy:
+                    bunka = sheet.cell(row=row, column=column)
+                    if bunka.value != hodnota:
+                        bunka.value = hodnota
+                        zmeneno = True
+
+                if zmeneno:
+                    self.uloz_excel(workbook)
+                    logging.info(f"Data úspěšně uložena do souboru: {self.excel_cesta}")
+                else:
+                    logging.info(f"Data se nezměnila, ukládání přeskočeno: {self.excel_cesta}")
         except Exception as e:
+            self.zahod_nacteny_excel()
             logging.error(f"Nepodařilo se uložit pracovní dobu: {e}")
             raise
 
     def nacti_data_pro_tyden(self, datum):
         try:
-            workbook = self.nacti_nebo_vytvor_excel()
-            sheet = self.ziskej_nebo_vytvor_list(workbook, datum)
+            if not os.path.exists(self.excel_cesta):
+                self.nacti_nebo_vytvor_excel()
+
+            nazev_listu = f"Týden {datum.isocalendar()[1]}"
+            radky = {}
+            # Pouze čtení: list se projde jednou (řádky 7 až 80) bez náhodného přístupu přes sheet.cell
+            workbook = load_workbook(self.excel_cesta, read_only=True, keep_links=False)
+            try:
+                if nazev_listu not in workbook.sheetnames and self.TEMPLATE_SHEET_NAME in workbook.sheetnames:
+                    # Chybějící list by vznikl kopií šablony, má tedy její hodnoty
+                    nazev_listu = self.TEMPLATE_SHEET_NAME
+                if nazev_listu in workbook.sheetnames:
+                    for cislo_radku, radek in enumerate(workbook[nazev_listu].iter_rows(
+                            min_row=7, max_row=80, max_col=15, values_only=True), start=7):
+                        if cislo_radku in (7, 8, 80):
+                            radky[cislo_radku] = radek
+                else:
+                    # Bez šablony by list vyplnil inicializuj_list, který do řádku 80 píše data dnů
+                    radek_data = [None] * 15
+                    prvni_den_tydne = datum - timedelta(days=datum.weekday())
+                    for i, sloupec in enumerate(_SLOUPCE_DNU):
+                        radek_data[sloupec - 1] = (prvni_den_tydne + timedelta(days=i)).strftime(FORMAT_DATA_LISTU)
+                    radky[80] = tuple(radek_data)
+            finally:
+                workbook.close()
+
+            prazdny_radek = (None,) * 15
+            radek_casu = radky.get(7, prazdny_radek)
+            radek_doby = radky.get(8, prazdny_radek)
+            radek_data = radky.get(80, prazdny_radek)
 
             data = []
-            for i in range(7):  # Pro každý den v týdnu
+            for sloupec in _SLOUPCE_DNU:  # Pro každý den v týdnu (index v n-tici je o 1 menší)
                 den_data = {
-                    "datum": sheet.cell(row=80, column=2 + i * 2).value,
-                    "zacatek": sheet.cell(row=7, column=2 + i * 2).value,
-                    "konec": sheet.cell(row=7, column=3 + i * 2).value,
-                    "pracovni_doba": sheet.cell(row=8, column=2 + i * 2).value
+                    "datum": radek_data[sloupec - 1],
+                    "zacatek": radek_casu[sloupec - 1],
+                    "konec": radek_casu[sloupec],
+                    "pracovni_doba": radek_doby[sloupec - 1]
                 }
                 data.append(den_data)
 
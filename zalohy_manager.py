@@ -1,7 +1,9 @@
 import os
+import weakref
 from openpyxl import load_workbook, Workbook
 import logging
-from datetime import datetime
+from excel_manager import (parsuj_datum, uloz_atomicky, zamek_souboru, nacteny_sesit,
+                           zapamatuj_sesit, zapomen_sesit, razitko_souboru)
 
 logging.basicConfig(filename='zalohy.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,88 +13,161 @@ class ZalohyManager:
         self.excel_cesta = "Hodiny_Cap.xlsx"
         self.ZALOHY_SHEET_NAME = 'Zálohy'
         self.EMPLOYEE_START_ROW = 9
+        # List -> {jméno zaměstnance: řádek, ...}; sešit načtený z novějšího souboru
+        # má nové objekty listů, takže index z neaktuálního listu se nikdy nepoužije
+        self._employee_row_cache = weakref.WeakKeyDictionary()
+        # (razítko souboru, (název možnosti 1, název možnosti 2))
+        self._option_names_cache = None
 
     def nacti_nebo_vytvor_excel(self):
         try:
-            if os.path.exists(self.excel_cesta):
-                workbook = load_workbook(self.excel_cesta)
-                logging.info(f"Načten existující Excel soubor: {self.excel_cesta}")
-            else:
-                workbook = Workbook()
-                workbook.save(self.excel_cesta)
-                logging.info(f"Vytvořen nový Excel soubor: {self.excel_cesta}")
-            
-            if self.ZALOHY_SHEET_NAME not in workbook.sheetnames:
-                workbook.create_sheet(self.ZALOHY_SHEET_NAME)
-                logging.info(f"Vytvořen nový list '{self.ZALOHY_SHEET_NAME}'")
-            
-            return workbook
+            # Sešit sdílí cache s ExcelManager, znovu se parsuje jen po změně souboru
+            with zamek_souboru(self.excel_cesta):
+                workbook = nacteny_sesit(self.excel_cesta)
+                if workbook is None:
+                    if os.path.exists(self.excel_cesta):
+                        workbook = load_workbook(self.excel_cesta)
+                        logging.info(f"Načten existující Excel soubor: {self.excel_cesta}")
+                    else:
+                        workbook = Workbook()
+                        workbook.save(self.excel_cesta)
+                        logging.info(f"Vytvořen nový Excel soubor: {self.excel_cesta}")
+                    zapamatuj_sesit(workbook, self.excel_cesta)
+                return workbook
         except Exception as e:
             logging.error(f"Chyba při načítání nebo vytváření Excel souboru: {e}")
             raise
 
-    def get_employee_row(self, employee_name):
-        workbook = self.nacti_nebo_vytvor_excel()
-        sheet = workbook[self.ZALOHY_SHEET_NAME]
-        for row in range(self.EMPLOYEE_START_ROW, sheet.max_row + 1):
-            if sheet.cell(row=row, column=1).value == employee_name:
-                return row
-        return None
+    def get_employee_row(self, employee_name, sheet=None):
+        # Sešit je sdílený celým procesem; čte se pod zámkem, aby se nepotkal s rozpracovaným zápisem
+        with zamek_souboru(self.excel_cesta):
+            if sheet is None:
+                workbook = self.nacti_nebo_vytvor_excel()
+                if self.ZALOHY_SHEET_NAME not in workbook.sheetnames:
+                    return None
+                sheet = workbook[self.ZALOHY_SHEET_NAME]
+            return self._employee_index(sheet)['rows'].get(employee_name)
+
+    def _file_stamp(self):
+        return razitko_souboru(self.excel_cesta)
+
+    def _employee_index(self, sheet):
+        cached = self._employee_row_cache.get(sheet)
+        if cached is not None:
+            return cached
+
+        # Jeden průchod sloupcem A místo volání sheet.cell pro každý řádek
+        rows = {}
+        occupied = set()
+        for row, (name,) in enumerate(
+                sheet.iter_rows(min_row=self.EMPLOYEE_START_ROW, max_col=1, values_only=True),
+                start=self.EMPLOYEE_START_ROW):
+            if name is not None:
+                occupied.add(row)
+                rows.setdefault(name, row)
+        index = {
+            'rows': rows,
+            'occupied': occupied,
+            'next_empty_row': self._first_free_row(occupied, self.EMPLOYEE_START_ROW),
+        }
+        self._employee_row_cache[sheet] = index
+        return index
+
+    @staticmethod
+    def _first_free_row(occupied, row):
+        while row in occupied:
+            row += 1
+        return row
 
     def add_or_update_employee_advance(self, employee_name, amount, currency, option, date):
         try:
-            workbook = self.nacti_nebo_vytvor_excel()
-            sheet = workbook[self.ZALOHY_SHEET_NAME]
-            row = self.get_employee_row(employee_name)
+            with zamek_souboru(self.excel_cesta):
+                workbook = self.nacti_nebo_vytvor_excel()
+                # List se zakládá jen tady, kde se sešit hned ukládá; v cache sdíleného
+                # sešitu nesmí zůstat neuložená změna
+                if self.ZALOHY_SHEET_NAME not in workbook.sheetnames:
+                    workbook.create_sheet(self.ZALOHY_SHEET_NAME)
+                    logging.info(f"Vytvořen nový list '{self.ZALOHY_SHEET_NAME}'")
+                sheet = workbook[self.ZALOHY_SHEET_NAME]
+                index = self._employee_index(sheet)
+                row = index['rows'].get(employee_name)
             
-            if row is None:
-                row = self.get_next_empty_row(sheet)
-                sheet.cell(row=row, column=1, value=employee_name)
+                if row is None:
+                    row = index['next_empty_row']
+                    sheet.cell(row=row, column=1, value=employee_name)
             
-            if option == 'option1':
-                column = 2 if currency == 'EUR' else 3
-            else:  # option2
-                column = 4 if currency == 'EUR' else 5
+                if option == 'option1':
+                    column = 2 if currency == 'EUR' else 3
+                else:  # option2
+                    column = 4 if currency == 'EUR' else 5
             
-            current_value = sheet.cell(row=row, column=column).value or 0
-            sheet.cell(row=row, column=column, value=current_value + amount)
+                current_value = sheet.cell(row=row, column=column).value or 0
+                sheet.cell(row=row, column=column, value=current_value + amount)
             
-            # Přidání data zálohy
-            date_column = 26  # Předpokládáme, že datum bude v sloupci Z
-            sheet.cell(row=row, column=date_column, value=datetime.strptime(date, '%Y-%m-%d').date())
+                # Přidání data zálohy
+                date_column = 26  # Předpokládáme, že datum bude v sloupci Z
+                sheet.cell(row=row, column=date_column, value=parsuj_datum(date))
             
-            workbook.save(self.excel_cesta)
-            logging.info(f"Záloha pro {employee_name} aktualizována: {amount} {currency} ({option}) k datu {date}")
-            return True
+                uloz_atomicky(workbook, self.excel_cesta)
+                zapamatuj_sesit(workbook, self.excel_cesta)
+                # Uložený sešit zůstává v cache se stejným listem, index řádků stačí doplnit
+                if employee_name not in index['rows']:
+                    occupied = index['occupied'] | {row}
+                    index = {
+                        'rows': {**index['rows'], employee_name: row},
+                        'occupied': occupied,
+                        'next_empty_row': self._first_free_row(occupied, row + 1),
+                    }
+                self._employee_row_cache[sheet] = index
+                logging.info(f"Záloha pro {employee_name} aktualizována: {amount} {currency} ({option}) k datu {date}")
+                return True
         except Exception as e:
+            zapomen_sesit(self.excel_cesta)
             logging.error(f"Chyba při ukládání zálohy: {e}")
             return False
 
     def get_next_empty_row(self, sheet):
-        for row in range(self.EMPLOYEE_START_ROW, sheet.max_row + 2):
-            if sheet.cell(row=row, column=1).value is None:
-                return row
-        return sheet.max_row + 1
+        return self._employee_index(sheet)['next_empty_row']
 
     def get_employee_advances(self, employee_name):
-        workbook = self.nacti_nebo_vytvor_excel()
-        sheet = workbook[self.ZALOHY_SHEET_NAME]
-        row = self.get_employee_row(employee_name)
-        if row is None:
-            return None
-        return {
-            'Option1_EUR': sheet.cell(row=row, column=2).value or 0,
-            'Option1_CZK': sheet.cell(row=row, column=3).value or 0,
-            'Option2_EUR': sheet.cell(row=row, column=4).value or 0,
-            'Option2_CZK': sheet.cell(row=row, column=5).value or 0
-        }
+        with zamek_souboru(self.excel_cesta):
+            workbook = self.nacti_nebo_vytvor_excel()
+            if self.ZALOHY_SHEET_NAME not in workbook.sheetnames:
+                return None
+            sheet = workbook[self.ZALOHY_SHEET_NAME]
+            row = self.get_employee_row(employee_name, sheet)
+            if row is None:
+                return None
+            return {
+                'Option1_EUR': sheet.cell(row=row, column=2).value or 0,
+                'Option1_CZK': sheet.cell(row=row, column=3).value or 0,
+                'Option2_EUR': sheet.cell(row=row, column=4).value or 0,
+                'Option2_CZK': sheet.cell(row=row, column=5).value or 0
+            }
 
     def get_option_names(self):
-        workbook = self.nacti_nebo_vytvor_excel()
-        sheet = workbook[self.ZALOHY_SHEET_NAME]
-        option1_name = sheet['B80'].value or 'Option 1'
-        option2_name = sheet['D80'].value or 'Option 2'
-        return option1_name, option2_name
+        if not os.path.exists(self.excel_cesta):
+            self.nacti_nebo_vytvor_excel()
+
+        stamp = self._file_stamp()
+        if self._option_names_cache is not None and self._option_names_cache[0] == stamp:
+            return self._option_names_cache[1]
+
+        # Stačí dvě buňky: soubor se otevře jen pro čtení a přečte se jediný řádek 80 (B až D)
+        option1_name = option2_name = None
+        workbook = load_workbook(self.excel_cesta, read_only=True, keep_links=False)
+        try:
+            if self.ZALOHY_SHEET_NAME in workbook.sheetnames:
+                sheet = workbook[self.ZALOHY_SHEET_NAME]
+                option1_name, _, option2_name = next(
+                    sheet.iter_rows(min_row=80, max_row=80, min_col=2, max_col=4, values_only=True),
+                    (None, None, None))
+        finally:
+            workbook.close()
+
+        names = (option1_name or 'Option 1', option2_name or 'Option 2')
+        self._option_names_cache = (stamp, names)
+        return names
 
 if __name__ == "__main__":
     # Test code